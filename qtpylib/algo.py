@@ -390,7 +390,7 @@ class Algo(Broker):
             # drip history
             drip_handler = self._tick_handler if self.resolution[-1] in (
                 "S", "K", "V") else self._bar_handler
-            self.blotter.drip(history, drip_handler)
+            self.blotter.drip(history, drip_handler, delay=0)
 
         else:
             # place history self.bars
@@ -736,7 +736,10 @@ class Algo(Broker):
         if len(symbol) == 0:
             return
         symbol = symbol[0]
-        self.last_price[symbol] = float(tick['last'].values[0])
+        last_price = float(tick['last'].values[0])
+        if self.last_price.get(symbol) != last_price:
+            self.last_price[symbol] = last_price
+            self._invalidate_trades_cache()  # unrealized pnl changed
 
         # work on copy
         self_ticks = self.ticks.copy()
@@ -21,8 +21,10 @@
 
 import argparse
 import atexit
+import csv
 import json
 import logging
+import multiprocessing
 import os
 import pickle
 
@@ -31,6 +33,7 @@ import tempfile
 import time
 import glob
 import subprocess
+import threading
 
 from datetime import datetime
 from abc import ABCMeta
@@ -77,8 +80,48 @@ asynctools.multitasking.createPool(__name__, __threads__)
 # =============================================
 
 cash_ticks = {}
+_blotter_args_cache = {}  # {(args_cache_file, mtime): args}
 
 
+def _json_default(o):
+    if isinstance(o, np_int64):
+        try:
+            return pd.to_datetime(o, unit='ms').strftime(
+                ibDataTypes["DATE_TIME_FORMAT_LONG"])
+        except Exception as e:
+            return int(o)
+    raise TypeError
+
+
+SYMBOLS_COLUMNS = ['symbol', 'sec_type', 'exchange',
+                   'currency', 'expiry', 'strike', 'opt_type']
+
+
+def _file_stat(filename):
+    try:
+        stat = os.stat(filename)
+        return stat.st_mtime, stat.st_size
+    except Exception as e:
+        return None
+
+
+def _symbols_row_key(row):
+    # normalize values so that 20180316 == "20180316" and 0.0 == "0"
+    key = []
+    for val in row:
+        val = str(val).strip()
+        try:
+            num = float(val)
+            if num.is_integer():
+                val = str(int(num))
+        except ValueError:
+            pass
+        key.append(val)
+    return tuple(key)
+
+
+# =============================================
+
 class Blotter():
     """Broker class initilizer
 
@@ -153,6 +196,8 @@ class Blotter():
         self.ibConn = None
 
         self.symbol_ids = {}  # cache
+        self._registered_symbols = None  # symbols csv rows cache
+        self._registered_symbols_stat = None
         self.cash_ticks = cash_ticks  # outside cache
         self.rtvolume = set()  # has RTVOLUME?
 
@@ -188,6 +233,8 @@ class Blotter():
         atexit.register(self._on_exit)
 
         # track historical data download status
+        self._backfilled = threading.Event()
+        self._ib_connected = threading.Event()
         self.backfilled = False
         self.backfilled_symbols = []
         self.backfill_resolution = "1 min"
@@ -195,6 +242,18 @@ class Blotter():
         # be aware of thread count
         self.threads = asynctools.multitasking.getPool(__name__)['threads']
 
+    # -------------------------------------------
+    @property
+    def backfilled(self):
+        return self._backfilled.is_set()
+
+    @backfilled.setter
+    def backfilled(self, value):
+        if value:
+            self._backfilled.set()
+        else:
+            self._backfilled.clear()
+
     # -------------------------------------------
     def _on_exit(self, terminate=True):
         if "as_client" in self.args:
@@ -265,11 +324,13 @@ class Blotter():
 
     def _read_cached_args(self):
         if os.path.exists(self.args_cache_file):
-            return pickle.load(open(self.args_cache_file, "rb"))
+            with open(self.args_cache_file, "rb") as f:
+                return pickle.load(f)
         return {}
 
     def _write_cached_args(self):
-        pickle.dump(self.args, open(self.args_cache_file, "wb"))
+        with open(self.args_cache_file, "wb") as f:
+            pickle.dump(self.args, f)
         tools.chmod(self.args_cache_file)
 
     # -------------------------------------------
@@ -315,7 +376,10 @@ class Blotter():
     # -------------------------------------------
     def ibCallback(self, caller, msg, **kwargs):
 
-        if caller == "handleConnectionClosed":
+        if caller == "handleConnectionOpened":
+            self._ib_connected.set()
+
+        elif caller == "handleConnectionClosed":
             self.log_blotter.info("Lost conncetion to Interactive Brokers...")
             self._on_exit(terminate=False)
             self.run()
@@ -676,17 +740,8 @@ class Blotter():
 
     # -------------------------------------------
     def broadcast(self, data, kind):
-        def int64_handler(o):
-            if isinstance(o, np_int64):
-                try:
-                    return pd.to_datetime(o, unit='ms').strftime(
-                        ibDataTypes["DATE_TIME_FORMAT_LONG"])
-                except Exception as e:
-                    return int(o)
-            raise TypeError
-
         string2send = "%s %s" % (
-            self.args["zmqtopic"], json.dumps(data, default=int64_handler))
+            self.args["zmqtopic"], json.dumps(data, default=_json_default))
 
         # print(kind, string2send)
         try:
@@ -754,9 +809,12 @@ class Blotter():
         # connect to mysql
         self.mysql_connect()
 
-        self.context = zmq.Context(zmq.REP)
-        self.socket = self.context.socket(zmq.PUB)
-        self.socket.bind("tcp://*:" + str(self.args['zmqport']))
+        # (run() is called again on reconnect - socket is already bound)
+        if self.socket is None:
+            self.context = zmq.Context.instance()
+            self.socket = self.context.socket(zmq.PUB)
+            self.socket.setsockopt(zmq.LINGER, 0)
+            self.socket.bind("tcp://*:" + str(self.args['zmqport']))
 
         db_modified = 0
         contracts = []
@@ -767,21 +825,25 @@ class Blotter():
         self.ibConn = ezIBpy()
         self.ibConn.ibCallback = self.ibCallback
 
+        # retry with exponential backoff, waking up as soon as
+        # ezIBpy reports the connection as opened (see ibCallback)
+        self._ib_connected.clear()
+        delay = 0.05
         while not self.ibConn.connected:
             self.ibConn.connect(clientId=int(self.args['ibclient']),
                                 port=int(self.args['ibport']), host=str(self.args['ibserver']))
-            time.sleep(1)
-            if not self.ibConn.connected:
-                print('*', end="", flush=True)
+            if self._ib_connected.wait(delay) or self.ibConn.connected:
+                break
+            self.log_blotter.debug("Not connected, retrying in %.2fs", delay)
+            delay = min(delay * 2, 1.0)
         self.log_blotter.info("Connection established...")
 
         try:
             while True:
 
                 if not os.path.exists(self.args['symbols']):
-                    pd.DataFrame(columns=['symbol', 'sec_type', 'exchange',
-                                          'currency', 'expiry', 'strike', 'opt_type']
-                                 ).to_csv(self.args['symbols'], header=True, index=False)
+                    pd.DataFrame(columns=SYMBOLS_COLUMNS).to_csv(
+                        self.args['symbols'], header=True, index=False)
                     tools.chmod(self.args['symbols'])
                 else:
                     time.sleep(0.1)
@@ -1030,8 +1092,9 @@ class Blotter():
         symbols = list(map(str.strip, symbols))
 
         # connect to zeromq self.socket
-        self.context = zmq.Context()
+        self.context = zmq.Context.instance()
         sock = self.context.socket(zmq.SUB)
+        sock.setsockopt(zmq.LINGER, 0)
         sock.setsockopt_string(zmq.SUBSCRIBE, "")
         sock.connect('tcp://127.0.0.1:' + str(self.args['zmqport']))
 
@@ -1062,19 +1125,21 @@ class Blotter():
                             continue
 
                     try:
-                        data["datetime"] = parse_date(data["timestamp"])
+                        data["datetime"] = tools.parse_date_cached(
+                            data["timestamp"])
                     except Exception as e:
                         pass
 
-                    df = pd.DataFrame(index=[0], data=data)
-                    df.set_index('datetime', inplace=True)
-                    df.index = pd.to_datetime(df.index, utc=True)
-                    df.drop(["timestamp", "kind"], axis=1, inplace=True)
+                    # build the single-row df with its index in place
+                    dt = pd.Timestamp(data["datetime"])
+                    if dt.tzinfo is None:
+                        dt = dt.tz_localize('UTC')
+                    index = pd.DatetimeIndex([dt.tz_convert(tz)],
+                                             name='datetime')
 
-                    try:
-                        df.index = df.index.tz_convert(tz)
-                    except Exception as e:
-                        df.index = df.index.tz_localize('UTC').tz_convert(tz)
+                    df = pd.DataFrame(index=index, data={
+                        k: v for k, v in data.items()
+                        if k not in ("datetime", "timestamp", "kind")})
 
                     # add options columns
                     df = tools.force_options_columns(df)
@@ -1094,13 +1159,45 @@ class Blotter():
             asynctools.multitasking.wait_for_tasks()  # wait for threads to complete
             sys.exit(1)
 
+        finally:
+            sock.close()
+
     # -------------------------------------------
     @staticmethod
-    def drip(data, handler):
+    def drip(data, handler, delay=0, as_dict=False):
+        """
+        Replays historical data row by row (used for backtesting)
+
+        :Parameters:
+            data : pd.DataFrame
+                Historical data (as returned by ``history()``)
+            handler : function
+                Function to pass each row to
+
+        :Optional:
+            delay : float
+                Seconds to wait between rows (default: 0). With no delay,
+                threaded handlers are waited for, so rows stay in order
+            as_dict : bool
+                Pass ``(datetime, row_dict)`` to the handler instead of
+                a single-row DataFrame (default: False)
+        """
+        def pause(task):
+            if delay > 0:
+                time.sleep(delay)
+            elif isinstance(task, (threading.Thread, multiprocessing.Process)):
+                # handler runs as a task - finish it before the next row
+                task.join()
+
         try:
-            for i in range(len(data)):
-                handler(data.iloc[i:i + 1])
-                time.sleep(.15)
+            if as_dict:
+                # no per-row DataFrame construction
+                columns = list(data.columns)
+                for row in data.itertuples(index=True, name=None):
+                    pause(handler(row[0], dict(zip(columns, row[1:]))))
+            else:
+                for i in range(len(data)):
+                    pause(handler(data.iloc[i:i + 1]))
 
             asynctools.multitasking.wait_for_tasks()
             print("\n\n>>> Backtesting Completed.")
@@ -1140,15 +1237,19 @@ class Blotter():
             return None
 
         # missing history?
+        now = datetime.utcnow()
         start_date = parse_date(start)
-        end_date = parse_date(end) if end else datetime.utcnow()
+        end_date = parse_date(end) if end else now
 
         if data.empty:
-            first_date = datetime.utcnow()
-            last_date = datetime.utcnow()
+            first_date = now
+            last_date = now
         else:
-            first_date = tools.datetime64_to_datetime(data.index.values[0])
-            last_date = tools.datetime64_to_datetime(data.index.values[-1])
+            # compare as naive UTC (same as start/end dates)
+            index = data.index[[0, -1]]
+            if index.tz is not None:
+                index = index.tz_convert('UTC').tz_localize(None)
+            first_date, last_date = index.to_pydatetime()
 
         ib_lookback = None
         if start_date < first_date:
@@ -1178,8 +1279,7 @@ class Blotter():
         self.ibConn.requestHistoricalData(**params)
 
         # wait for backfill to complete
-        while not self.backfilled:
-            time.sleep(0.01)
+        self._backfilled.wait()
 
         # otherwise, pass the parameters to the caller
         return True
@@ -1193,18 +1293,52 @@ class Blotter():
         if not isinstance(instruments, list):
             return
 
-        db = pd.read_csv(self.args['symbols'], header=0).fillna("")
+        symbols_file = self.args['symbols']
+        registered = self._read_registered_symbols(symbols_file)
+
+        new_rows = []
+        for instrument in instruments:
+            row = ["" if val is None or val != val else val  # None/NaN
+                   for val in instrument]
+            key = _symbols_row_key(row)
+            if key not in registered:
+                registered.add(key)
+                new_rows.append(row)
+
+        if not new_rows:
+            return
 
-        instruments = pd.DataFrame(instruments)
-        instruments.columns = db.columns
-        # instruments['expiry'] = instruments['expiry'].astype(int).astype(str)
+        # append new rows only (header if file is new)
+        write_header = not os.path.exists(symbols_file) or \
+            os.path.getsize(symbols_file) == 0
+        with open(symbols_file, 'a', newline='') as f:
+            writer = csv.writer(f)
+            if write_header:
+                writer.writerow(SYMBOLS_COLUMNS)
+            writer.writerows(new_rows)
 
-        db = db.append(instruments)
-        # db['expiry'] = db['expiry'].astype(int)
-        db = db.drop_duplicates(keep="first")
+        tools.chmod(symbols_file)
+        self._registered_symbols_stat = _file_stat(symbols_file)
 
-        db.to_csv(self.args['symbols'], header=True, index=False)
-        tools.chmod(self.args['symbols'])
+    # -------------------------------------------
+    def _read_registered_symbols(self, symbols_file):
+        # re-read only if the file was changed by someone else
+        # (ie. the blotter removing expired contracts)
+        stat = _file_stat(symbols_file)
+        if self._registered_symbols is not None and \
+                stat == self._registered_symbols_stat:
+            return self._registered_symbols
+
+        registered = set()
+        if stat is not None:
+            with open(symbols_file, newline='') as f:
+                reader = csv.reader(f)
+                next(reader, None)  # header
+                registered = set(_symbols_row_key(row) for row in reader)
+
+        self._registered_symbols = registered
+        self._registered_symbols_stat = stat
+        return registered
 
     # -------------------------------------------
     def get_mysql_connection(self):
@@ -1306,22 +1440,27 @@ def load_blotter_args(blotter_name=None, logger=None):
 
     # no name provided - connect to last running
     else:
-        blotter_files = sorted(
-            glob.glob(tempfile.gettempdir() + "/*.qtpylib"), key=os.path.getmtime)
+        args_cache_file = max(
+            glob.iglob(tempfile.gettempdir() + "/*.qtpylib"),
+            key=os.path.getmtime, default=None)
 
-        if not blotter_files:
+        if args_cache_file is None:
             logger.critical(
                 "Cannot connect to running Blotter [%s]", blotter_name)
             if os.isatty(0):
                 sys.exit(0)
             return []
 
-        args_cache_file = blotter_files[-1]
-
-    args = pickle.load(open(args_cache_file, "rb"))
-    args['as_client'] = True
+    # re-use args if the cache file hasn't changed since last read
+    cache_key = (args_cache_file, os.path.getmtime(args_cache_file))
+    if cache_key not in _blotter_args_cache:
+        with open(args_cache_file, "rb") as f:
+            args = pickle.load(f)
+        args['as_client'] = True
+        _blotter_args_cache.clear()
+        _blotter_args_cache[cache_key] = args
 
-    return args
+    return dict(_blotter_args_cache[cache_key])
 
 # -------------------------------------------
 
@@ -1512,29 +1651,29 @@ def prepare_history(data, resolution="1T", tz="UTC", continuous=True):
     data['expiry'] = pd.to_datetime(data['expiry'], utc=True)
 
     # remove _STK from symbol to match ezIBpy's formatting
-    data['symbol'] = data['symbol'].str.replace("_STK", "")
+    # (done once per unique symbol instead of once per row)
+    data['symbol'] = data['symbol'].map({
+        sym: sym.replace("_STK", "") for sym in data['symbol'].unique()
+        if isinstance(sym, str)})
 
     # force options columns
     data = tools.force_options_columns(data)
 
     # construct continuous contracts for futures
     if continuous and resolution[-1] not in ("K", "V", "S"):
-        all_dfs = [data[data['asset_class'] != 'FUT']]
-
-        # generate dict of df per future
-        futures_symbol_groups = list(
-            data[data['asset_class'] == 'FUT']['symbol_group'].unique())
-        for key in futures_symbol_groups:
-            future_group = data[data['symbol_group'] == key]
-            continuous = futures.create_continuous_contract(
-                future_group, resolution)
-            all_dfs.append(continuous)
-
-        # make one df again
-        # data = pd.concat(all_dfs, sort=True)
-        data['datetime'] = data.index
-        data.groupby([data.index, 'symbol'], as_index=False
-                     ).last().set_index('datetime').dropna()
+        is_future = data['asset_class'] == 'FUT'
+
+        if is_future.any():
+            all_dfs = [data[~is_future]]
+
+            # split futures by symbol group in a single pass
+            for _, future_group in data[is_future].groupby(
+                    'symbol_group', sort=False):
+                all_dfs.append(futures.create_continuous_contract(
+                    future_group, resolution))
+
+            # make one df again
+            data = pd.concat(all_dfs, sort=True)
 
     data = tools.resample(data, resolution, tz)
     return data
@@ -20,16 +20,19 @@
 #
 
 import atexit
+import csv
+import functools
 import hashlib
+import heapq
 import logging
 import os
+import queue
 import time
 import sys
-
-# from decimal import *
-import decimal
+import threading
 
 from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
 from datetime import datetime, timedelta
 
 import numpy as np
@@ -45,8 +48,6 @@ from qtpylib.blotter import (
     Blotter, load_blotter_args
 )
 
-decimal.getcontext().prec = 5
-
 
 # =============================================
 # check min, python version
@@ -55,6 +56,83 @@ if sys.version_info < (3, 4):
 
 # =============================================
 tools.createLogger(__name__)
+
+# =============================================
+# trades are written to mysql in batches
+TRADES_BATCH_SIZE = 100
+TRADES_FLUSH_INTERVAL = 1  # seconds
+TRADES_BUFFER_MAX = 10000  # trades kept while mysql is unreachable
+
+# errors after which buffered trades are kept and retried
+TRADES_CONNECTION_ERRORS = (pymysql.err.OperationalError,
+                            pymysql.err.InterfaceError)
+
+# multi-row friendly upsert (executemany() sends all rows in one statement)
+TRADES_SQL = """INSERT INTO trades (
+    `algo`, `symbol`, `direction`,`quantity`,
+    `entry_time`, `exit_time`, `exit_reason`,
+    `order_type`, `market_price`, `target`, `stop`,
+    `entry_price`, `exit_price`, `realized_pnl`)
+    VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
+    ON DUPLICATE KEY UPDATE
+        `algo`=VALUES(`algo`), `symbol`=VALUES(`symbol`),
+        `direction`=VALUES(`direction`), `quantity`=VALUES(`quantity`),
+        `entry_time`=VALUES(`entry_time`), `exit_time`=VALUES(`exit_time`),
+        `exit_reason`=VALUES(`exit_reason`), `order_type`=VALUES(`order_type`),
+        `market_price`=VALUES(`market_price`), `target`=VALUES(`target`),
+        `stop`=VALUES(`stop`), `entry_price`=VALUES(`entry_price`),
+        `exit_price`=VALUES(`exit_price`), `realized_pnl`=VALUES(`realized_pnl`)
+    """
+
+# order side <-> trade direction
+ORDER_SIDES = {"BUY": "BUY", "LONG": "BUY", "SELL": "SELL", "SHORT": "SELL"}
+TRADE_DIRECTIONS = {"BUY": "LONG", "SELL": "SHORT"}
+
+# max. time a fill waits for its order to be registered by _create_order
+ORDER_REGISTER_TIMEOUT = 0.2  # seconds
+
+# delay between IB reconnection attempts (doubles after each try)
+RECONNECT_MIN_DELAY = 1.3  # seconds
+RECONNECT_MAX_DELAY = 30  # seconds
+
+# max. time to wait on exit for queued trades to be written
+TRADES_EXIT_TIMEOUT = 10  # seconds
+
+# ezibpy order statuses (upper-cased IB statuses)
+ORDER_OPEN_STATES = frozenset(("OPENED", "SUBMITTED"))
+ORDER_CANCELLED_STATES = frozenset(("CANCELLED", "APICANCELLED"))
+
+TRADES_DTYPES = {
+    'entry_price': float, 'exit_price': float, 'market_price': float,
+    'realized_pnl': float, 'stop': float, 'target': float, 'quantity': int
+}
+
+TRADE_LOG_COLUMNS = [
+    'strategy', 'symbol', 'direction', 'quantity', 'entry_time',
+    'exit_time', 'exit_reason', 'order_type', 'market_price', 'target',
+    'stop', 'entry_price', 'exit_price', 'realized_pnl'
+]
+# =============================================
+
+
+@functools.lru_cache(maxsize=4096)
+def _format_duration(seconds):
+    """ formats seconds as "1d 2h 3m 4s" (omitting zero d/h/m units) """
+    days, remainder = divmod(seconds, 86400)
+    hours, remainder = divmod(remainder, 3600)
+    minutes, seconds = divmod(remainder, 60)
+
+    parts = []
+    if days:
+        parts.append('%sd' % days)
+    if hours:
+        parts.append('%sh' % hours)
+    if minutes:
+        parts.append('%sm' % minutes)
+    parts.append('%ss' % seconds)
+    return ' '.join(parts)
+
+
 # =============================================
 
 
@@ -75,6 +153,15 @@ class Broker():
 
     __metaclass__ = ABCMeta
 
+    # defaults (overridden by ``Algo``)
+    timezone = "UTC"
+    tick_window = 1000
+    bar_window = 100
+    backtest = False
+    sms_numbers = None
+    trade_log_dir = None
+    blotter_name = None
+
     def __init__(self, instruments, ibclient=998, ibport=4001, ibserver="localhost"):
 
         # detect running strategy
@@ -85,22 +172,9 @@ class Broker():
 
         # -----------------------------------
         # assign default vals if not propogated from algo
-        if not hasattr(self, 'timezone'):
-            self.timezone = "UTC"
-        if not hasattr(self, 'tick_window'):
-            self.tick_window = 1000
-        if not hasattr(self, 'bar_window'):
-            self.bar_window = 100
+        # (immutable defaults are class attributes)
         if not hasattr(self, 'last_price'):
             self.last_price = {}
-        if not hasattr(self, 'backtest'):
-            self.backtest = False
-        if not hasattr(self, 'sms_numbers'):
-            self.sms_numbers = []
-        if not hasattr(self, 'trade_log_dir'):
-            self.trade_log_dir = None
-        if not hasattr(self, 'blotter_name'):
-            self.blotter_name = None
 
         # -----------------------------------
         # connect to IB
@@ -110,12 +184,15 @@ class Broker():
 
         self.ibConn = ezibpy.ezIBpy()
         self.ibConn.ibCallback = self.ibCallback
-        # self.ibConnect()
+
+        # replace ezibpy's reconnect() (retries every second, blocking the
+        # callback thread) with a background loop that backs off
+        self._reconnect_thread = None
+        self.ibConn.reconnect = self._reconnect
 
         connection_tries = 0
         while not self.ibConn.connected:
-            self.ibConn.connect(clientId=self.ibclient,
-                                port=self.ibport, host=self.ibserver)
+            self.ibConnect()
             time.sleep(1)
             if not self.ibConn.connected:
                 # print('*', end="", flush=True)
@@ -145,11 +222,19 @@ class Broker():
         self.instruments = instrument_tuples_dict
         self.symbols = list(self.instruments.keys())
         self.instrument_combos = {}
+        self._combo_parents = {}  # parent/leg symbol -> parent symbol
+
+        # symbol -> tickerId (ezibpy scans all its tickerIds per lookup).
+        # never reset: ezibpy keeps its tickerIds across reconnects
+        self._tickerids = {}
 
         # -----------------------------------
         # track orders & trades
         self.active_trades = {}
         self.trades = []
+        self._trade_ids = {}  # symbol -> tradeId
+        self._trades_cache = {}  # symbol -> (version, get_trades() result)
+        self._trades_version = 0  # bumped when trades / last prices change
 
         # shortcut
         self.account = self.ibConn.account
@@ -160,13 +245,20 @@ class Broker():
             by_symbol=self.ibConn.symbol_orders,
             pending_ttls={},
             pending={},
+            pending_expiries=[],
             filled={},
             active={},
             history={},
+            by_type={},
+            children={},
             nextId=1,
             recent={}
         )
 
+        # notified once _create_order has registered an order in orders.recent
+        self._orders_registered = threading.Condition()
+        self._submitting = set()  # symbols with orders being submitted
+
         # -----------------------------------
         self.dbcurr = None
         self.dbconn = None
@@ -188,6 +280,19 @@ class Broker():
                 autocommit=True
             )
             self.dbcurr = self.dbconn.cursor()
+
+        # rows of today's trade log csv (by entry_time, symbol, strategy)
+        self._trade_log_path = None
+        self._trade_log_rows = OrderedDict()
+
+        # trades are written to mysql/csv in batches by a writer thread
+        self._trades_buffer = []
+        self._trades_queue = queue.Queue()
+        self._trades_thread = threading.Thread(
+            target=self._trades_writer, name="trades-writer")
+        self._trades_thread.daemon = True
+        self._trades_thread.start()
+
         # -----------------------------------
         # do stuff on exit
         atexit.register(self._on_exit)
@@ -199,11 +304,11 @@ class Broker():
             if isinstance(instrument, ezibpy.utils.Contract):
                 instrument = self.ibConn.contract_to_tuple(instrument)
                 contractString = self.ibConn.contractString(instrument)
+                if contractString not in self.instruments:
+                    self.symbols.append(contractString)
                 self.instruments[contractString] = instrument
                 self.ibConn.createContract(instrument)
 
-        self.symbols = list(self.instruments.keys())
-
     # ---------------------------------------
 
     @abstractmethod
@@ -225,17 +330,26 @@ class Broker():
             legs_dict[leg] = self.get_instrument(leg)
         self.instrument_combos[parent] = legs_dict
 
+        # re-index parents and legs for get_combo()
+        # (rebuilt, so re-registered combos drop their old legs)
+        combo_parents = {}
+        for combo, combo_legs in self.instrument_combos.items():
+            combo_parents.setdefault(combo, combo)
+            for leg in combo_legs:
+                combo_parents.setdefault(leg, combo)
+        self._combo_parents = combo_parents
+
     def get_combo(self, symbol):
         """ get group by child symbol """
-        for parent, legs in self.instrument_combos.items():
-            if symbol == parent or symbol in legs.keys():
-                return {
-                    "parent": self.get_instrument(parent),
-                    "legs": legs,
-                }
+        parent = self._combo_parents.get(symbol)
+        if parent is None:
+            return {
+                "parent": None,
+                "legs": {},
+            }
         return {
-            "parent": None,
-            "legs": {},
+            "parent": self.get_instrument(parent),
+            "legs": self.instrument_combos[parent],
         }
 
     # -------------------------------------------
@@ -246,6 +360,14 @@ class Broker():
             self.log_broker.info("Disconnecting...")
             self.ibConn.disconnect()
 
+        # write whatever trades are still queued
+        self._trades_queue.put(None)
+        self._trades_thread.join(timeout=TRADES_EXIT_TIMEOUT)
+        if self._trades_thread.is_alive():
+            self.log_broker.error(
+                "Trade writer still busy, %s queued trade(s) not written",
+                max(self._trades_queue.qsize() - 1, 0))
+
         self.log_broker.info("Disconnecting from MySQL...")
         try:
             self.dbcurr.close()
@@ -255,10 +377,36 @@ class Broker():
 
     # ---------------------------------------
     def ibConnect(self):
+        # ezibpy's connect() (re)subscribes to positions and account
         self.ibConn.connect(clientId=self.ibclient,
                             host=self.ibserver, port=self.ibport)
-        self.ibConn.requestPositionUpdates(subscribe=True)
-        self.ibConn.requestAccountUpdates(subscribe=True)
+
+    # ---------------------------------------
+    def _reconnect(self):
+        """ called by ezibpy on "handleConnectionClosed" """
+        if self._reconnect_thread is None or \
+                not self._reconnect_thread.is_alive():
+            self._reconnect_thread = threading.Thread(
+                target=self._reconnect_loop, name="ib-reconnect")
+            self._reconnect_thread.daemon = True
+            self._reconnect_thread.start()
+
+    # ---------------------------------------
+    def _reconnect_loop(self):
+        """ reconnects to IB with exponential backoff """
+        delay = RECONNECT_MIN_DELAY
+        while not self.ibConn.connected and \
+                not getattr(self.ibConn, "_disconnected_by_user", False):
+            try:
+                self.ibConnect()
+            except Exception as e:
+                self.log_broker.error("Cannot reconnect to IB: %s", e)
+
+            if self.ibConn.connected:
+                break
+            print('*', end="", flush=True)
+            time.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
 
     # ---------------------------------------
     # @abstractmethod
@@ -269,14 +417,10 @@ class Broker():
             self.blotter.ibCallback("handleHistoricalData", msg, **kwargs)
 
         if caller == "handleConnectionClosed":
+            # ezibpy then calls _reconnect() (unless disconnected by user)
             self.log_broker.info("Lost conncetion to Interactive Brokers...")
 
-            while not self.ibConn.connected:
-                self.ibConnect()
-                time.sleep(1.3)
-                if not self.ibConn.connected:
-                    print('*', end="", flush=True)
-
+        elif caller == "handleConnectionOpened":
             self.log_broker.info("Connection established...")
 
         elif caller == "handleOrders":
@@ -287,22 +431,15 @@ class Broker():
                 return
 
             # order canceled? do some cleanup
-            if hasattr(msg, 'status') and "CANCELLED" in msg.status.upper():
-                if msg.orderId in self.orders.recent.keys():
-                    symbol = self.orders.recent[msg.orderId]['symbol']
-                    try:
-                        del self.orders.pending_ttls[msg.orderId]
-                    except Exception as e:
-                        pass
-                    try:
-                        del self.orders.recent[msg.orderId]
-                    except Exception as e:
-                        pass
-                    try:
-                        if self.orders.pending[symbol]['orderId'] == msg.orderId:
-                            del self.orders.pending[symbol]
-                    except Exception as e:
-                        pass
+            status = getattr(msg, 'status', None)
+            if status is not None and status.upper() in ORDER_CANCELLED_STATES:
+                recent = self.orders.recent.pop(msg.orderId, None)
+                if recent is not None:
+                    symbol = recent['symbol']
+                    self.orders.pending_ttls.pop(msg.orderId, None)
+                    pending = self.orders.pending.get(symbol)
+                    if pending is not None and pending['orderId'] == msg.orderId:
+                        del self.orders.pending[symbol]
                 return
 
             # continue...
@@ -313,6 +450,14 @@ class Broker():
             orderId = msg.orderId
             symbol = order["symbol"]
 
+            # fills can arrive before _create_order registered the order
+            # (only wait while this broker is submitting for the symbol)
+            if order["status"] == "FILLED" and symbol in self._submitting:
+                with self._orders_registered:
+                    self._orders_registered.wait_for(
+                        lambda: symbol not in self._submitting,
+                        timeout=ORDER_REGISTER_TIMEOUT)
+
             try:
                 try:
                     quantity = self.orders.history[symbol][orderId]['quantity']
@@ -323,7 +468,7 @@ class Broker():
                 quantity = 1
 
             # update pending order to the time actually submitted
-            if order["status"] in ["OPENED", "SUBMITTED"]:
+            if order["status"] in ORDER_OPEN_STATES:
                 if orderId in self.orders.pending_ttls:
                     self._update_pending_order(symbol, orderId,
                                                self.orders.pending_ttls[orderId],
@@ -337,7 +482,6 @@ class Broker():
                 self._register_trade(order)
 
                 # filled
-                time.sleep(0.005)
                 self.on_fill(self.get_instrument(order['symbol']), order)
 
     # ---------------------------------------
@@ -384,9 +528,12 @@ class Broker():
         if order_data is None:
             return None
 
-        # trade identifier
-        tradeId = self.strategy.upper() + '_' + symbol.upper()
-        tradeId = hashlib.sha1(tradeId.encode()).hexdigest()
+        # trade identifier (cached per symbol)
+        tradeId = self._trade_ids.get(symbol)
+        if tradeId is None:
+            tradeId = self.strategy.upper() + '_' + symbol.upper()
+            tradeId = hashlib.sha1(tradeId.encode()).hexdigest()
+            self._trade_ids[symbol] = tradeId
 
         # existing trade?
         if tradeId not in self.active_trades:
@@ -425,13 +572,7 @@ class Broker():
             try:
                 delta = int((self.active_trades[tradeId]['exit_time'] -
                              self.active_trades[tradeId]['entry_time']).total_seconds())
-                days, remainder = divmod(delta, 86400)
-                hours, remainder = divmod(remainder, 3600)
-                minutes, seconds = divmod(remainder, 60)
-                duration = ('%sd %sh %sm %ss' %
-                            (days, hours, minutes, seconds))
-                self.active_trades[tradeId]['duration'] = duration.replace(
-                    "0d ", "").replace("0h ", "").replace("0m ", "")
+                self.active_trades[tradeId]['duration'] = _format_duration(delta)
             except Exception as e:
                 pass
 
@@ -450,27 +591,52 @@ class Broker():
         # print(self.active_trades[tradeId])
         # print("-----------------\n\n")
 
-        # get trade
-        trade = self.active_trades[tradeId].copy()
+        # get trade (closed trades are removed from active trades,
+        # so only open ones need to be copied)
+        if self.active_trades[tradeId]['action'] == "EXIT":
+            trade = self.active_trades.pop(tradeId)
+        else:
+            trade = self.active_trades[tradeId].copy()
 
-        # sms trades
-        sms._send_trade(trade, self.sms_numbers, self.timezone)
+        # sms trades in the background (sms formats the trade it's given)
+        if self.sms_numbers:
+            self._send_sms_trade(trade.copy())
 
         # rename trade direction
-        trade['direction'] = trade['direction'].replace(
-            "BUY", "LONG").replace("SELL", "SHORT")
+        trade['direction'] = TRADE_DIRECTIONS.get(
+            trade['direction'], trade['direction'])
 
         # log
         self.log_trade(trade)
 
-        # remove from active trades and add to trade
+        # add to trades
         if trade['action'] == "EXIT":
-            del self.active_trades[tradeId]
             self.trades.append(trade)
 
+        # trades changed
+        self._invalidate_trades_cache()
+
         # return trade
         return trade
 
+    # ---------------------------------------
+    def _invalidate_trades_cache(self):
+        """ drops cached get_trades() results (trades / last price changed) """
+        self._trades_version += 1
+        self._trades_cache = {}
+
+    # ---------------------------------------
+    def _send_sms_trade(self, trade):
+        """ sends the trade sms without blocking the fill callback """
+        def _send():
+            try:
+                sms._send_trade(trade, self.sms_numbers, self.timezone)
+            except Exception as e:
+                self.log_broker.error("Cannot send trade sms: %s", e)
+
+        # not a daemon: pending messages are still sent on exit
+        threading.Thread(target=_send, name="sms-trade").start()
+
     # ---------------------------------------
     def log_trade(self, trade):
 
@@ -478,97 +644,206 @@ class Broker():
         if trade['entry_time'] is None:
             return
 
-        # connection established
-        if (self.dbconn is not None) & (self.dbcurr is not None):
-
-            sql = """INSERT INTO trades (
-                `algo`, `symbol`, `direction`,`quantity`,
-                `entry_time`, `exit_time`, `exit_reason`,
-                `order_type`, `market_price`, `target`, `stop`,
-                `entry_price`, `exit_price`, `realized_pnl`)
-                VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
-                ON DUPLICATE KEY UPDATE
-                    `algo`=%s, `symbol`=%s, `direction`=%s, `quantity`=%s,
-                    `entry_time`=%s, `exit_time`=%s, `exit_reason`=%s,
-                    `order_type`=%s, `market_price`=%s, `target`=%s, `stop`=%s,
-                    `entry_price`=%s, `exit_price`=%s, `realized_pnl`=%s
-                """
+        # nowhere to log to
+        if self.dbconn is None and not self.trade_log_dir:
+            return
+
+        # hand a copy over to the writer thread (the trade is also kept
+        # in self.trades) so mysql/disk i/o never blocks the tick loop
+        self._trades_queue.put(trade.copy())
 
+    # ---------------------------------------
+    def _trades_writer(self):
+        """ writer thread: drains the trades queue in batches """
+        while True:
             try:
-                trade['entry_time'] = trade['entry_time'].strftime(
-                    "%Y-%m-%d %H:%M:%S.%f")
-            except Exception as e:
-                pass
+                trades = [self._trades_queue.get(
+                    timeout=TRADES_FLUSH_INTERVAL)]
+            except queue.Empty:
+                # retry trades that couldn't be written before
+                self._flush_trades()
+                continue
+
+            while len(trades) < TRADES_BATCH_SIZE:
+                try:
+                    trades.append(self._trades_queue.get_nowait())
+                except queue.Empty:
+                    break
 
+            # None is the shutdown sentinel (see _on_exit)
+            stop = None in trades
+            self._write_trades([trade for trade in trades if trade is not None])
+            if stop:
+                return
+
+    # ---------------------------------------
+    def _write_trades(self, trades):
+        """ writes a batch of trades to mysql and the trade log csv """
+        for trade in trades:
             try:
-                trade['exit_time'] = trade['exit_time'].strftime(
-                    "%Y-%m-%d %H:%M:%S.%f")
+                # same time format for mysql and the csv log
+                # (on a copy - self.trades holds the same dicts)
+                trade = dict(trade)
+
+                try:
+                    trade['entry_time'] = trade['entry_time'].strftime(
+                        "%Y-%m-%d %H:%M:%S.%f")
+                except Exception as e:
+                    pass
+
+                try:
+                    trade['exit_time'] = trade['exit_time'].strftime(
+                        "%Y-%m-%d %H:%M:%S.%f")
+                except Exception as e:
+                    pass
+
+                # connection established
+                if (self.dbconn is not None) & (self.dbcurr is not None):
+
+                    # let pymysql escape native values (it can't handle numpy scalars)
+                    trade = {k: v.item() if isinstance(v, np.generic) else v
+                             for k, v in trade.items()}
+
+                    self._trades_buffer.append((
+                        trade['strategy'], trade['symbol'], trade['direction'], trade['quantity'],
+                        trade['entry_time'], trade['exit_time'], trade['exit_reason'],
+                        trade['order_type'], trade['market_price'], trade['target'], trade['stop'],
+                        trade['entry_price'], trade['exit_price'], trade['realized_pnl']
+                    ))
+
+                if self.trade_log_dir:
+                    self._log_trade_csv(trade)
+
             except Exception as e:
-                pass
+                self.log_broker.error("Cannot log trade: %s", e)
+
+        self._flush_trades()
+
+    # ---------------------------------------
+    def _log_trade_csv(self, trade):
+        self.trade_log_dir = (self.trade_log_dir + '/').replace('//', '/')
+        trade_log_path = self.trade_log_dir + self.strategy.lower() + "_" + \
+            datetime.now().strftime('%Y%m%d') + ".csv"
+
+        # convert None to empty string !!
+        row = ['' if trade[col] is None else trade[col]
+               for col in TRADE_LOG_COLUMNS]
+        key = (str(trade['entry_time']), str(trade['symbol']),
+               str(trade['strategy']))
+
+        rows = self._read_trade_log(trade_log_path)
+        updated = key in rows
+        rows[key] = row
+
+        if updated:
+            # an exit replaces its entry row - rewrite from memory
+            self._write_trade_log(trade_log_path, rows)
+        else:
+            write_header = not os.path.exists(trade_log_path)
+            with open(trade_log_path, 'a', newline='') as f:
+                writer = csv.writer(f)
+                if write_header:
+                    writer.writerow(TRADE_LOG_COLUMNS)
+                writer.writerow(row)
 
-            # all strings
-            for k, v in trade.items():
-                if v is not None:
-                    trade[k] = str(v)
-
-            self.dbcurr.execute(sql, (
-                trade['strategy'], trade['symbol'], trade['direction'], trade['quantity'],
-                trade['entry_time'], trade['exit_time'], trade['exit_reason'],
-                trade['order_type'], trade['market_price'], trade['target'], trade['stop'],
-                trade['entry_price'], trade['exit_price'], trade['realized_pnl'],
-                trade['strategy'], trade['symbol'], trade['direction'], trade['quantity'],
-                trade['entry_time'], trade['exit_time'], trade['exit_reason'],
-                trade['order_type'], trade['market_price'], trade['target'], trade['stop'],
-                trade['entry_price'], trade['exit_price'], trade['realized_pnl']
-            ))
-
-            # commit
+        tools.chmod(trade_log_path)
+
+    # ---------------------------------------
+    def _read_trade_log(self, trade_log_path):
+        """ loads the trade log csv once per file (new file every day) """
+        if trade_log_path == self._trade_log_path:
+            return self._trade_log_rows
+
+        rows = OrderedDict()
+        header = None
+        if os.path.exists(trade_log_path):
+            with open(trade_log_path, newline='') as f:
+                reader = csv.DictReader(f)
+                for line in reader:
+                    row = [line.get(col, '') for col in TRADE_LOG_COLUMNS]
+                    rows[(row[4], row[1], row[0])] = row
+                header = reader.fieldnames
+
+        # older versions wrote the columns sorted alphabetically -
+        # rewrite so appended rows line up with the header
+        if header and list(header) != TRADE_LOG_COLUMNS:
+            self._write_trade_log(trade_log_path, rows)
+
+        self._trade_log_path = trade_log_path
+        self._trade_log_rows = rows
+        return rows
+
+    # ---------------------------------------
+    @staticmethod
+    def _write_trade_log(trade_log_path, rows):
+        with open(trade_log_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(TRADE_LOG_COLUMNS)
+            writer.writerows(rows.values())
+
+    # ---------------------------------------
+    def _flush_trades(self):
+        """ writes buffered trades to mysql using a single executemany() """
+        # only called from the writer thread, so the cursor is never shared
+        if not self._trades_buffer or self.dbcurr is None:
+            return
+
+        try:
             try:
-                self.dbconn.commit()
+                self.dbcurr.executemany(TRADES_SQL, self._trades_buffer)
+            except TRADES_CONNECTION_ERRORS as e:
+                # connection dropped (ie. wait_timeout) - reconnect once
+                self.dbconn.ping(reconnect=True)
+                self.dbcurr.executemany(TRADES_SQL, self._trades_buffer)
+            self.dbconn.commit()
+            self._trades_buffer = []
+            return
+
+        except TRADES_CONNECTION_ERRORS as e:
+            # mysql is unreachable - keep the trades for the next attempt
+            self.log_broker.error("Cannot log trades to MySQL: %s", e)
+
+        except Exception as e:
+            # a bad row fails the whole batch - write the rows one by one
+            # and drop the ones mysql rejects
+            self.log_broker.error("Cannot log trades to MySQL: %s", e)
+            self._flush_trades_per_row()
+
+        # don't let the buffer grow forever while mysql is down
+        dropped = len(self._trades_buffer) - TRADES_BUFFER_MAX
+        if dropped > 0:
+            self.log_broker.error(
+                "Trades buffer is full, dropping %s trades", dropped)
+            del self._trades_buffer[:dropped]
+
+    # ---------------------------------------
+    def _flush_trades_per_row(self):
+        rows = self._trades_buffer
+        for i, row in enumerate(rows):
+            try:
+                self.dbcurr.execute(TRADES_SQL, row)
+            except TRADES_CONNECTION_ERRORS as e:
+                # keep this and the remaining trades for the next attempt
+                self.log_broker.error("Cannot log trades to MySQL: %s", e)
+                self._trades_buffer = rows[i:]
+                return
             except Exception as e:
-                pass
+                self.log_broker.error(
+                    "Cannot log trade to MySQL, dropping it: %s %s", e, row)
 
-        if self.trade_log_dir:
-            self.trade_log_dir = (self.trade_log_dir + '/').replace('//', '/')
-            trade_log_path = self.trade_log_dir + self.strategy.lower() + "_" + \
-                datetime.now().strftime('%Y%m%d') + ".csv"
-
-            # convert None to empty string !!
-            trade.update((k, '') for k, v in trade.items() if v is None)
-
-            # create df
-            trade_df = pd.DataFrame(index=[0], data=trade)[[
-                'strategy', 'symbol', 'direction', 'quantity', 'entry_time',
-                'exit_time', 'exit_reason', 'order_type', 'market_price', 'target',
-                'stop', 'entry_price', 'exit_price', 'realized_pnl'
-            ]]
-
-            if os.path.exists(trade_log_path):
-                trades = pd.read_csv(trade_log_path, header=0)
-                trades = trades.append(trade_df, ignore_index=True, sort=True)
-                trades.drop_duplicates(['entry_time', 'symbol', 'strategy'],
-                                       keep="last", inplace=True)
-                trades.to_csv(trade_log_path, header=True, index=False)
-                tools.chmod(trade_log_path)
-            else:
-                trade_df.to_csv(trade_log_path, header=True, index=False)
-                tools.chmod(trade_log_path)
+        try:
+            self.dbconn.commit()
+        except Exception as e:
+            pass
+        self._trades_buffer = []
 
     # ---------------------------------------
     def active_order(self, symbol, order_type="STOP"):
-        if symbol in self.orders.history:
-            for orderId in self.orders.history[symbol]:
-                order = self.orders.history[symbol][orderId]
-                if order['order_type'].upper() == order_type.upper():
-                    return order
+        orderIds = self.orders.by_type.get(symbol, {}).get(order_type.upper())
+        if orderIds:
+            return self.orders.history[symbol][next(iter(orderIds))]
         return None
 
-    # ---------------------------------------
-    @staticmethod
-    def _get_locals(local_params):
-        del local_params['self']
-        return local_params
-
     # ---------------------------------------
     def _create_order(self, symbol, direction, quantity, order_type="",
                       limit_price=0, expiry=0, orderId=0, target=0,
@@ -584,11 +859,12 @@ class Broker():
         trail_stop_by = tools.round_to_fraction(trail_stop_by, ticksize)
         trail_stop_type = "amount" if trail_stop_type == "amount" else "percent"
 
-        self.log_broker.debug('CREATE ORDER: %s %4d %s %s', direction,
-                              quantity, symbol, dict(locals(), **kwargs))
+        if self.log_broker.isEnabledFor(logging.DEBUG):
+            self.log_broker.debug('CREATE ORDER: %s %4d %s %s', direction,
+                                  quantity, symbol, dict(locals(), **kwargs))
 
         # force BUY/SELL (not LONG/SHORT)
-        direction = direction.replace("LONG", "BUY").replace("SHORT", "SELL")
+        direction = ORDER_SIDES.get(direction.upper(), direction)
 
         # modify order?
         if order_type.upper() == "MODIFY":
@@ -617,7 +893,7 @@ class Broker():
 
         # continue...
         order_quantity = abs(quantity)
-        if direction.upper() == "SELL":
+        if direction == "SELL":
             order_quantity = -order_quantity
 
         contract = self.get_contract(symbol)
@@ -626,81 +902,96 @@ class Broker():
         bracket = (target > 0) | (initial_stop > 0) | (
             trail_stop_at > 0) | (trail_stop_by > 0)
 
-        # create & submit order
-        if not bracket:
-            # simple order
-            order = self.ibConn.createOrder(order_quantity, limit_price,
-                                            fillorkill=fillorkill,
-                                            iceberg=iceberg,
-                                            tif=tif)
-
-            orderId = self.ibConn.placeOrder(contract, order)
-            self.log_broker.debug('PLACE ORDER: %s %s', tools.contract_to_dict(
-                contract), tools.order_to_dict(order))
-        else:
-            # bracket order
-            order = self.ibConn.createBracketOrder(contract, order_quantity,
-                                                   entry=limit_price,
-                                                   target=target,
-                                                   stop=initial_stop,
-                                                   stop_limit=stop_limit,
-                                                   fillorkill=fillorkill,
-                                                   iceberg=iceberg,
-                                                   tif=tif)
-            orderId = order["entryOrderId"]
-
-            # triggered trailing stop?
-            if trail_stop_by != 0 and trail_stop_at != 0:
-                trail_stop_params = {
+        # fills for this symbol wait until the order is registered
+        with self._orders_registered:
+            self._submitting.add(symbol)
+
+        try:
+            # create & submit order
+            if not bracket:
+                # simple order
+                order = self.ibConn.createOrder(order_quantity, limit_price,
+                                                fillorkill=fillorkill,
+                                                iceberg=iceberg,
+                                                tif=tif)
+
+                orderId = self.ibConn.placeOrder(contract, order)
+                self.log_broker.debug('PLACE ORDER: %s %s', tools.contract_to_dict(
+                    contract), tools.order_to_dict(order))
+            else:
+                # bracket order
+                order = self.ibConn.createBracketOrder(contract, order_quantity,
+                                                       entry=limit_price,
+                                                       target=target,
+                                                       stop=initial_stop,
+                                                       stop_limit=stop_limit,
+                                                       fillorkill=fillorkill,
+                                                       iceberg=iceberg,
+                                                       tif=tif)
+                orderId = order["entryOrderId"]
+
+                # triggered trailing stop?
+                if trail_stop_by != 0 and trail_stop_at != 0:
+                    trail_stop_params = {
+                        "symbol": symbol,
+                        "quantity": -order_quantity,
+                        "triggerPrice": trail_stop_at,
+                        "parentId": order["entryOrderId"],
+                        "stopOrderId": order["stopOrderId"]
+                    }
+                    if trail_stop_type.lower() == 'amount':
+                        trail_stop_params["trailAmount"] = trail_stop_by
+                    else:
+                        trail_stop_params["trailPercent"] = trail_stop_by
+                    self.ibConn.createTriggerableTrailingStop(**trail_stop_params)
+
+                # add all orders to history
+                self._update_order_history(symbol=symbol,
+                                           orderId=order["entryOrderId"],
+                                           quantity=order_quantity,
+                                           order_type='ENTRY')
+
+                self._update_order_history(symbol=symbol,
+                                           orderId=order["targetOrderId"],
+                                           quantity=-order_quantity,
+                                           order_type='TARGET',
+                                           parentId=order["entryOrderId"])
+
+                self._update_order_history(symbol=symbol,
+                                           orderId=order["stopOrderId"],
+                                           quantity=-order_quantity,
+                                           order_type='STOP',
+                                           parentId=order["entryOrderId"])
+
+            # register the order for the FILL event (fills wait on this lock)
+            with self._orders_registered:
+                self.orders.recent[orderId] = {
                     "symbol": symbol,
-                    "quantity": -order_quantity,
-                    "triggerPrice": trail_stop_at,
-                    "parentId": order["entryOrderId"],
-                    "stopOrderId": order["stopOrderId"]
+                    "direction": direction,
+                    "quantity": quantity,
+                    "order_type": order_type,
+                    "limit_price": limit_price,
+                    "expiry": expiry,
+                    "target": target,
+                    "initial_stop": initial_stop,
+                    "trail_stop_at": trail_stop_at,
+                    "trail_stop_by": trail_stop_by,
+                    "ticksize": ticksize,
+                    "order": order,
+                    "targetOrderId": order["targetOrderId"] if bracket else 0,
+                    "stopOrderId": order["stopOrderId"] if bracket else 0
                 }
-                if trail_stop_type.lower() == 'amount':
-                    trail_stop_params["trailAmount"] = trail_stop_by
-                else:
-                    trail_stop_params["trailPercent"] = trail_stop_by
-                self.ibConn.createTriggerableTrailingStop(**trail_stop_params)
-
-            # add all orders to history
-            self._update_order_history(symbol=symbol,
-                                       orderId=order["entryOrderId"],
-                                       quantity=order_quantity,
-                                       order_type='ENTRY')
-
-            self._update_order_history(symbol=symbol,
-                                       orderId=order["targetOrderId"],
-                                       quantity=-order_quantity,
-                                       order_type='TARGET',
-                                       parentId=order["entryOrderId"])
-
-            self._update_order_history(symbol=symbol,
-                                       orderId=order["stopOrderId"],
-                                       quantity=-order_quantity,
-                                       order_type='STOP',
-                                       parentId=order["entryOrderId"])
-
-        # have original params available for FILL event
-        self.orders.recent[orderId] = self._get_locals(locals())
-        self.orders.recent[orderId]['targetOrderId'] = 0
-        self.orders.recent[orderId]['stopOrderId'] = 0
-
-        if bracket:
-            self.orders.recent[orderId]['targetOrderId'] = order["targetOrderId"]
-            self.orders.recent[orderId]['stopOrderId'] = order["stopOrderId"]
-
-        # append market price at the time of order
-        try:
-            self.orders.recent[orderId]['price'] = self.last_price[symbol]
-        except Exception as e:
-            self.orders.recent[orderId]['price'] = 0
 
-        # add orderId / ttl to (auto-adds to history)
-        expiry = expiry * 1000 if expiry > 0 else 60000  # 1min
-        self._update_pending_order(symbol, orderId, expiry, order_quantity)
-        time.sleep(0.1)
+                # append market price at the time of order
+                self.orders.recent[orderId]['price'] = self.last_price.get(symbol, 0)
+
+                # add orderId / ttl to (auto-adds to history)
+                expiry = expiry * 1000 if expiry > 0 else 60000  # 1min
+                self._update_pending_order(symbol, orderId, expiry, order_quantity)
+        finally:
+            with self._orders_registered:
+                self._submitting.discard(symbol)
+                self._orders_registered.notify_all()
 
     # ---------------------------------------
     def _cancel_order(self, orderId):
@@ -730,91 +1021,89 @@ class Broker():
         if quantity is None and limit_price is None:
             return
 
-        if symbol in self.orders.history:
-            for historyOrderId in self.orders.history[symbol]:
-                if historyOrderId == orderId:
-                    order_quantity = self.orders.history[symbol][orderId]['quantity']
-                    if quantity is not None:
-                        order_quantity = quantity
-
-                    order = self.orders.history[symbol][orderId]
-                    if order['order_type'] == "STOP":
-                        new_order = self.ibConn.createStopOrder(
-                            quantity=order_quantity,
-                            parentId=order['parentId'],
-                            stop=limit_price,
-                            trail=None,
-                            transmit=True
-                        )
-                    else:
-                        new_order = self.ibConn.createOrder(
-                            order_quantity, limit_price)
+        order = self.orders.history.get(symbol, {}).get(orderId)
+        if order is None:
+            return
 
-                        # child order?
-                        if "parentId" in order:
-                            new_order.parentId = order['parentId']
+        order_quantity = order['quantity']
+        if quantity is not None:
+            order_quantity = quantity
+
+        if order['order_type'] == "STOP":
+            new_order = self.ibConn.createStopOrder(
+                quantity=order_quantity,
+                parentId=order['parentId'],
+                stop=limit_price,
+                trail=None,
+                transmit=True
+            )
+        else:
+            new_order = self.ibConn.createOrder(
+                order_quantity, limit_price)
 
-                    #  send order
-                    contract = self.get_contract(symbol)
-                    self.ibConn.placeOrder(
-                        contract, new_order, orderId=orderId)
-                    break
+            # child order?
+            if "parentId" in order:
+                new_order.parentId = order['parentId']
 
-    # ---------------------------------------
-    @staticmethod
-    def _milliseconds_delta(delta):
-        return delta.days * 86400000 + delta.seconds * 1000 + delta.microseconds / 1000
+        #  send order
+        contract = self.get_contract(symbol)
+        self.ibConn.placeOrder(
+            contract, new_order, orderId=orderId)
 
     # ---------------------------------------
     def _cancel_orphan_orders(self, orderId):
-        """ cancel child orders when parent is gone """
-        orders = self.ibConn.orders
-        for order in orders:
-            order = orders[order]
-            if order['parentId'] != orderId:
-                self.ibConn.cancelOrder(order['id'])
+        """ cancel sibling orders when a child order (target/stop) fills """
+        try:
+            parentId = self.ibConn.orders[orderId]['parentId']
+        except Exception as e:
+            return
+
+        for childId in self.orders.children.pop(parentId, ()):
+            if childId != orderId:
+                self.ibConn.cancelOrder(childId)
 
     # ---------------------------------------
     def _cancel_expired_pending_orders(self):
         """ expires pending orders """
-        # use a copy to prevent errors
-        pending = self.orders.pending.copy()
-        for symbol in pending:
-            orderId = pending[symbol]["orderId"]
-            expiration = pending[symbol]["expires"]
-
-            delta = expiration - datetime.now()
-            delta = self._milliseconds_delta(delta)
-
-            # cancel order if expired
-            if delta < 0:
-                self.ibConn.cancelOrder(orderId)
-                if orderId in self.orders.pending_ttls:
-                    if orderId in self.orders.pending_ttls:
-                        del self.orders.pending_ttls[orderId]
-                    if symbol in self.orders.pending:
-                        if self.orders.pending[symbol]['orderId'] == orderId:
-                            del self.orders.pending[symbol]
+        # pop expired entries from the (expires, orderId, symbol) heap
+        expiries = self.orders.pending_expiries
+        now = datetime.now()
+        while expiries and expiries[0][0] < now:
+            expiration, orderId, symbol = heapq.heappop(expiries)
+
+            # skip stale entries (order is gone or its ttl was updated)
+            pending = self.orders.pending.get(symbol)
+            if pending is None or pending['orderId'] != orderId or \
+                    pending['expires'] != expiration:
+                continue
+
+            # cancel order
+            self.ibConn.cancelOrder(orderId)
+            if orderId in self.orders.pending_ttls:
+                del self.orders.pending_ttls[orderId]
+                del self.orders.pending[symbol]
 
     # ---------------------------------------------------------
     def _expire_pending_order(self, symbol, orderId):
         self.ibConn.cancelOrder(orderId)
 
-        if orderId in self.orders.pending_ttls:
-            del self.orders.pending_ttls[orderId]
+        self.orders.pending_ttls.pop(orderId, None)
 
-        if symbol in self.orders.pending:
-            if self.orders.pending[symbol]['orderId'] == orderId:
-                del self.orders.pending[symbol]
+        pending = self.orders.pending.get(symbol)
+        if pending is not None and pending['orderId'] == orderId:
+            del self.orders.pending[symbol]
 
     # ---------------------------------------------------------
     def _update_pending_order(self, symbol, orderId, expiry, quantity):
+        expires = datetime.now() + timedelta(milliseconds=expiry)
         self.orders.pending[symbol] = {
             "orderId": orderId,
             "quantity": quantity,
             # "created": datetime.now(),
-            "expires": datetime.now() + timedelta(milliseconds=expiry)
+            "expires": expires
         }
+        heapq.heappush(self.orders.pending_expiries,
+                       (expires, orderId, symbol))
 
         # ibCallback needs this to update with submittion time
         self.orders.pending_ttls[orderId] = expiry
@@ -826,15 +1115,29 @@ class Broker():
                               order_type='entry', filled=False, parentId=0):
         if symbol not in self.orders.history:
             self.orders.history[symbol] = {}
+            self.orders.by_type[symbol] = {}
+
+        order_type = order_type.upper()
+        previous = self.orders.history[symbol].get(orderId)
 
         self.orders.history[symbol][orderId] = {
             "orderId": orderId,
             "quantity": quantity,
-            "order_type": order_type.upper(),
+            "order_type": order_type,
             "filled": filled,
             "parentId": parentId
         }
 
+        # index order ids by type (used by active_order)
+        by_type = self.orders.by_type[symbol]
+        if previous is not None and previous['order_type'] != order_type:
+            by_type[previous['order_type']].pop(orderId, None)
+        by_type.setdefault(order_type, OrderedDict())[orderId] = True
+
+        # track child orders by their parent
+        if parentId:
+            self.orders.children.setdefault(parentId, set()).add(orderId)
+
     # ---------------------------------------
     # UTILITY FUNCTIONS
     # ---------------------------------------
@@ -862,11 +1165,14 @@ class Broker():
     # ---------------------------------------
     @staticmethod
     def get_symbol(symbol):
-        if not isinstance(symbol, str):
-            if isinstance(symbol, dict):
-                symbol = symbol['symbol']
-            elif isinstance(symbol, pd.DataFrame):
-                symbol = symbol[:1]['symbol'].values[0]
+        # plain strings are the common case
+        if type(symbol) is str:
+            return symbol
+
+        if isinstance(symbol, dict):
+            return symbol['symbol']
+        elif isinstance(symbol, pd.DataFrame):
+            return symbol[:1]['symbol'].values[0]
 
         return symbol
 
@@ -876,25 +1182,38 @@ class Broker():
 
     # ---------------------------------------
     def get_contract(self, symbol):
-        return self.ibConn.contracts[self.ibConn.tickerId(symbol)]
+        return self.ibConn.contracts[self.get_tickerId(symbol)]
 
     # ---------------------------------------
     def get_contract_details(self, symbol):
-        return self.ibConn.contractDetails(symbol)
+        # pass the (cached) tickerId so ezibpy doesn't look it up again
+        return self.ibConn.contractDetails(self.get_tickerId(symbol))
 
     # ---------------------------------------
     def get_tickerId(self, symbol):
-        return self.ibConn.tickerId(symbol)
+        # only symbol strings are cached (contracts go to ezibpy)
+        if not isinstance(symbol, str):
+            return self.ibConn.tickerId(symbol)
+
+        try:
+            return self._tickerids[symbol]
+        except KeyError as e:
+            tickerId = self.ibConn.tickerId(symbol)
+            self._tickerids[symbol] = tickerId
+            return tickerId
 
     # ---------------------------------------
     def get_orders(self, symbol):
         symbol = self.get_symbol(symbol)
 
-        self.orders.by_symbol = self.ibConn.group_orders("symbol")
-        if symbol in self.orders.by_symbol:
-            return self.orders.by_symbol[symbol]
+        # ezibpy regroups its orders by symbol on every order event,
+        # so only regroup here for orders sent but not yet acknowledged
+        by_symbol = self.ibConn.symbol_orders
+        if sum(map(len, by_symbol.values())) != len(self.ibConn.orders):
+            by_symbol = self.ibConn.group_orders("symbol")
 
-        return {}
+        self.orders.by_symbol = by_symbol
+        return by_symbol.get(symbol, {})
 
     # ---------------------------------------
     def get_positions(self, symbol):
@@ -966,50 +1285,58 @@ class Broker():
     # ---------------------------------------
     def get_trades(self, symbol=None):
 
-        # closed trades
-        trades = pd.DataFrame(self.trades)
-        if not trades.empty:
-            trades.loc[:, 'closed'] = True
-
-        # ongoing trades
-        active_trades = pd.DataFrame(list(self.active_trades.values()))
-        if not active_trades.empty:
-            active_trades.loc[:, 'closed'] = False
-
-        # combine dataframes
-        df = pd.concat([trades, active_trades], sort=True).reset_index()
+        # cached until a trade or a last price changes
+        cache_key = None if symbol is None else str(symbol)
+        version = self._trades_version
+        cached = self._trades_cache.get(cache_key)
+        if cached is not None and cached[0] == version:
+            return cached[1].copy()
 
-        # set last price
-        if not df.empty:
+        # closed + ongoing trades (columns sorted, closed trades first)
+        trades = self.trades
+        rows = trades + list(self.active_trades.values())
+        num_closed = len(trades)
 
-            # conert values to floats
-            df['entry_price'] = df['entry_price'].astype(float)
-            df['exit_price'] = df['exit_price'].astype(float)
-            df['market_price'] = df['market_price'].astype(float)
-            df['realized_pnl'] = df['realized_pnl'].astype(float)
-            df['stop'] = df['stop'].astype(float)
-            df['target'] = df['target'].astype(float)
-            df['quantity'] = df['quantity'].astype(int)
+        # no trades yet
+        if not rows:
+            return pd.DataFrame()
 
-            try:
-                df.loc[:, 'last'] = self.last_price[symbol]
-            except Exception as e:
-                df.loc[:, 'last'] = 0
+        columns = sorted(set(['closed']).union(*rows))
 
-            # calc unrealized pnl
-            df['unrealized_pnl'] = np.where(df['direction'] == "SHORT",
-                                            df['entry_price'] - df['last'],
-                                            df['last'] - df['entry_price'])
-
-            df.loc[df['closed'], 'unrealized_pnl'] = 0
+        # single symbol? keep the rows' positions in the combined list
+        positions = range(len(rows))
+        if symbol is not None:
+            base_symbol = symbol.split("_", 1)[0]
+            positions = [i for i in positions
+                         if rows[i]['symbol'] == base_symbol]
+
+        df = pd.DataFrame([rows[i] for i in positions],
+                          columns=columns, index=list(positions))
+        df['closed'] = df.index.values < num_closed
+
+        # conert values to floats (in one pass)
+        df = df.astype(TRADES_DTYPES)
+
+        # last price (per row when not filtering by symbol)
+        # trades store the base symbol, last_price uses the full one
+        if symbol is None:
+            last_prices = dict((sym.split("_", 1)[0],
+                                self.last_price.get(sym, 0))
+                               for sym in self.symbols)
+            df['last'] = df['symbol'].map(last_prices).fillna(0)
+        else:
+            df['last'] = self.last_price.get(symbol, 0)
 
-            # drop index column
-            df.drop('index', axis=1, inplace=True)
+        # calc unrealized pnl (zero for closed trades)
+        sign = np.where(df['direction'].values == "SHORT", -1., 1.)
+        unrealized_pnl = sign * (df['last'].values - df['entry_price'].values)
+        unrealized_pnl[df['closed'].values] = 0
+        df['unrealized_pnl'] = unrealized_pnl
 
-            # get single symbol
-            if symbol is not None:
-                df = df[df['symbol'] == symbol.split("_")[0]]
-                df.loc[:, 'symbol'] = symbol
+        # get single symbol (already filtered)
+        if symbol is not None:
+            df['symbol'] = symbol
 
-        # return
-        return df
+        # return (a copy, so callers can't alter the cached frame)
+        self._trades_cache[cache_key] = (version, df)
+        return df.copy()
@@ -79,8 +79,10 @@ def create_continuous_contract(df, resolution="1T"):
             flags = _merge_contracts(flags, new_contract)
 
         # add gap
+        # (each expiration overwrites the gap of all rows up to it, so only
+        # the latest expiration with a usable gap matters - search backwards)
         flags['gap'] = 0
-        for expiration in expirations:
+        for expiration in reversed(expirations):
             try:
                 minidf = daily_df[daily_df.index ==
                                   expiration][['symbol', 'expiry', 'diff']]
@@ -90,6 +92,7 @@ def create_continuous_contract(df, resolution="1T"):
                 ]['expiry'][0]
                 gap = minidf[minidf['expiry'] == expiry]['diff'][0]
                 flags.loc[flags.index <= expiration, 'gap'] = gap
+                break
             except Exception as e:
                 pass
 
@@ -140,10 +143,9 @@ def create_continuous_contract(df, resolution="1T"):
     contract.drop(['expiry_y', 'expiry_x'], axis=1, inplace=True)
 
     try:
-        contract['open'] = contract['open'] + contract['gap']
-        contract['high'] = contract['high'] + contract['gap']
-        contract['low'] = contract['low'] + contract['gap']
-        contract['close'] = contract['close'] + contract['gap']
+        ohlc = ['open', 'high', 'low', 'close']
+        contract[ohlc] = contract[ohlc].values + \
+            contract['gap'].values[:, None]
         # contract['volume'] = df['volume'].resample("D").sum()
     except Exception as e:
         contract['last'] = contract['last'] + contract['gap']
@@ -20,6 +20,7 @@
 #
 
 import datetime
+import functools
 import time
 import os
 import sys
@@ -127,6 +128,11 @@ def week_started_date(as_datetime=False):
 
 # ---------------------------------------------
 
+# defaults for missing contract tuple fields
+# (symbol, sec_type, exchange, currency, expiry, strike, right)
+_IB_TUPLE_DEFAULTS = (None, "STK", "SMART", "USD", "", 0.0, "")
+
+
 def create_ib_tuple(instrument):
     """ create ib contract tuple """
     from qtpylib import futures
@@ -169,17 +175,8 @@ def create_ib_tuple(instrument):
 
     # tuples without strike/right
     elif len(instrument) <= 7:
-        instrument_list = list(instrument)
-        if len(instrument_list) < 3:
-            instrument_list.append("SMART")
-        if len(instrument_list) < 4:
-            instrument_list.append("USD")
-        if len(instrument_list) < 5:
-            instrument_list.append("")
-        if len(instrument_list) < 6:
-            instrument_list.append(0.0)
-        if len(instrument_list) < 7:
-            instrument_list.append("")
+        instrument_list = list(instrument) + \
+            list(_IB_TUPLE_DEFAULTS[len(instrument):])
 
         try:
             instrument_list[4] = int(instrument_list[4])
@@ -256,35 +253,21 @@ def mark_options_values(data):
 
 # ---------------------------------------------
 
-def force_options_columns(data):
-    opt_cols = ['opt_price', 'opt_underlying', 'opt_dividend', 'opt_volume',
-                'opt_iv', 'opt_oi', 'opt_delta', 'opt_gamma', 'opt_vega', 'opt_theta']
+OPTIONS_COLUMNS = ('opt_price', 'opt_underlying', 'opt_dividend',
+                   'opt_volume', 'opt_iv', 'opt_oi', 'opt_delta',
+                   'opt_gamma', 'opt_vega', 'opt_theta')
 
+
+def force_options_columns(data):
+    # only add the missing columns (keeps existing values)
     if isinstance(data, dict):
-        if not set(opt_cols).issubset(data.keys()):
-            data['opt_price'] = None
-            data['opt_underlying'] = None
-            data['opt_dividend'] = None
-            data['opt_volume'] = None
-            data['opt_iv'] = None
-            data['opt_oi'] = None
-            data['opt_delta'] = None
-            data['opt_gamma'] = None
-            data['opt_vega'] = None
-            data['opt_theta'] = None
+        for col in OPTIONS_COLUMNS:
+            data.setdefault(col, None)
 
     elif isinstance(data, pd.DataFrame):
-        if not set(opt_cols).issubset(data.columns):
-            data.loc[:, 'opt_price'] = np.nan
-            data.loc[:, 'opt_underlying'] = np.nan
-            data.loc[:, 'opt_dividend'] = np.nan
-            data.loc[:, 'opt_volume'] = np.nan
-            data.loc[:, 'opt_iv'] = np.nan
-            data.loc[:, 'opt_oi'] = np.nan
-            data.loc[:, 'opt_delta'] = np.nan
-            data.loc[:, 'opt_gamma'] = np.nan
-            data.loc[:, 'opt_vega'] = np.nan
-            data.loc[:, 'opt_theta'] = np.nan
+        missing = [col for col in OPTIONS_COLUMNS if col not in data.columns]
+        if missing:
+            data = data.reindex(columns=list(data.columns) + missing)
 
     return data
 
@@ -358,6 +341,19 @@ def datetime64_to_datetime(dt):
     return datetime.datetime.utcfromtimestamp(ts)
 
 
+# ---------------------------------------------
+
+@functools.lru_cache(maxsize=8192)
+def parse_date_cached(date_str):
+    """ parse date string (cached, as timestamps repeat across symbols)
+    using fromisoformat() for ISO strings and dateutil's parser otherwise """
+    try:
+        return datetime.datetime.fromisoformat(date_str)
+    except (AttributeError, TypeError, ValueError):
+        # AttributeError: fromisoformat() requires python >= 3.7
+        return parse_date(date_str)
+
+
 # ---------------------------------------------
 
 def round_to_fraction(val, res, decimals=None):